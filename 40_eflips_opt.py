@@ -3,14 +3,19 @@
 
 from typing import Dict, Union, Tuple, List
 
-import numpy as np
+import pandas as pd
+import plotly.io as pio
 from eflips.model.general import VehicleType
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, joinedload
-from eflips.model import Rotation, Trip, Station
-from collections import Counter
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from eflips.model import Rotation, Route, Trip, Station
+import matplotlib
+
+# This script only writes the plots to files, so we do not need an interactive backend
+matplotlib.use("Agg")
 from matplotlib import pyplot as plt
 import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 from eflips.eval.input.prepare import rotation_info as prepare_rotation_info
 from eflips.eval.input.visualize import rotation_info as visualize_rotation_info
@@ -32,21 +37,66 @@ engine = create_engine(DATABASE_URL)
 session = Session(engine)
 
 
+def depot_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Counts the number of rotations originating at each depot.
+    :param df: A dataframe as returned by `prepare_geographic_trip_plot()` or `depot_rotation_summary()`.
+    :return: A dataframe with the columns "originating_depot_name", "originating_depot_id" and "n".
+    """
+    rotations = df.drop_duplicates(subset=["rotation_id"])
+    # Rotations without a depot name are not counted. Rotations without a depot id are, so the id must not be dropped
+    # by the groupby.
+    rotations = rotations.dropna(subset=["originating_depot_name"])
+    # There are only a few depots, so grouping on categorical codes is cheaper than hashing the name strings
+    rotations = rotations.astype({"originating_depot_name": "category"})
+    return (
+        rotations.groupby(
+            ["originating_depot_name", "originating_depot_id"],
+            observed=True,
+            dropna=False,
+        )
+        .size()
+        .reset_index(name="n")
+        .astype({"originating_depot_name": str})
+    )
+
+
+def depot_rotation_summary(scenario_id: int, session: Session) -> pd.DataFrame:
+    """
+    Loads the originating depot of each rotation in a scenario. This is a lightweight alternative to
+    `prepare_geographic_trip_plot()` if only the depot of each rotation is needed, as it does not load any geometries.
+    :param scenario_id: The id of the scenario.
+    :param session: An open database session.
+    :return: A dataframe with the columns "rotation_id", "originating_depot_id" and "originating_depot_name".
+    """
+    # The originating depot is the departure station of the first trip of each rotation
+    query = (
+        select(Trip.rotation_id, Station.id, Station.name)
+        .join(Route, Trip.route_id == Route.id)
+        .join(Station, Route.departure_station_id == Station.id)
+        .where(Trip.scenario_id == scenario_id)
+        .distinct(Trip.rotation_id)
+        .order_by(Trip.rotation_id, Trip.departure_time)
+    )
+    return pd.DataFrame(
+        session.execute(query).all(),
+        columns=["rotation_id", "originating_depot_id", "originating_depot_name"],
+    )
+
+
 # Save a geographic trip plot
-df = prepare_geographic_trip_plot(1, session)
+# df = prepare_geographic_trip_plot(1, session)
 # map = visualize_geographic_trip_plot(df) TODO: RE-ENABLE
 # map.save(os.path.join("src", "media", "pre_opt_geographic_trip_plot.html"))
 
 
 # Also, prepare for a bar chart of how many rotations each depot supports
-# Create a counter of the number of rotations per depot
-pre_opt_counter = Counter()
-dropped = df.drop_duplicates(subset=["rotation_id"])
-grouped = dropped.groupby("originating_depot_name")
-for depot, group in grouped:
-    name_and_id = group[["originating_depot_name", "originating_depot_id"]].iloc[0]
-    print(list(name_and_id))
-    pre_opt_counter[depot] = len(group)
+# As long as the plot above is disabled, we only load the depot of each rotation
+# This needs to be done before the optimization results are written
+pre_opt_depot_counts = depot_counts(depot_rotation_summary(1, session))
+for row in pre_opt_depot_counts.itertuples(index=False):
+    print([row.originating_depot_name, row.originating_depot_id])
+pre_opt_counts = pre_opt_depot_counts.groupby("originating_depot_name")["n"].sum()
 
 # # Put the new capacities into a variable
 #
@@ -70,95 +120,46 @@ for depot, group in grouped:
 # - "vehicle_type": A list of vehicle type ids that can be used at this depot
 # - "name": The name of the depot (only for new depots)
 #
-depot_list: List[Dict[str, Dict[str, Union[int, Tuple[float, float], List[int]]]]] = []
-all_vehicle_type_ids = (
-    session.query(VehicleType.id).filter(VehicleType.scenario_id == SCENARIO_ID).all()
-)
-all_vehicle_type_ids = [x[0] for x in all_vehicle_type_ids]
-
-# "Abstellfläche Mariendorf" will have a capacity of zero
-depot_list.append(
-    {"depot_station": 103159411, "capacity": 0, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Spandau will hava a capacity of 220
-# "Abstellfläche Mariendorf" will have a capacity of zero
-depot_list.append(
-    {"depot_station": 103109411, "capacity": 220, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Indira-Gandhi-Straße" will have a capacity of 300
-depot_list.append(
-    {"depot_station": 150518, "capacity": 300, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Britz" will have a capacity of 140
-depot_list.append(
-    {"depot_station": 80181, "capacity": 140, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Cicerostraße" will have a capacity of 209
-depot_list.append(
-    {"depot_station": 103109407, "capacity": 209, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Müllerstraße" will have a capacity of 155
-depot_list.append(
-    {"depot_station": 103109408, "capacity": 155, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Lichtenberg" will have a capacity of 120
-depot_list.append(
-    {"depot_station": 160522, "capacity": 120, "vehicle_type": all_vehicle_type_ids}
-)
-
-# "Betriebshof Köpenicker Landstraße" will have a capacity of 200
-depot_list.append(
-    {
-        "depot_station": (13.4964867, 52.4654085),
-        "name": "Betriebshof Köpenicker Landstraße",
-        "capacity": 200,
-        "vehicle_type": all_vehicle_type_ids,
-    }
-)
-
-# "Betriebshof Rummelsburger Landstraße" will have a capacity of 60
-depot_list.append(
-    {
-        "depot_station": (13.5053889, 52.4714167),
-        "name": "Betriebshof Rummelsburger Landstraße",
-        "capacity": 60,
+all_vehicle_type_ids = session.scalars(
+    select(VehicleType.id).where(VehicleType.scenario_id == SCENARIO_ID)
+).all()
+
+# (depot station id or (lon, lat) tuple, name (only for new depots), capacity)
+depot_entries: List[Tuple[Union[int, Tuple[float, float]], str | None, int]] = [
+    (103159411, None, 0),  # "Abstellfläche Mariendorf"
+    (103109411, None, 220),  # "Betriebshof Spandau"
+    (150518, None, 300),  # "Betriebshof Indira-Gandhi-Straße"
+    (80181, None, 140),  # "Betriebshof Britz"
+    (103109407, None, 209),  # "Betriebshof Cicerostraße"
+    (103109408, None, 155),  # "Betriebshof Müllerstraße"
+    (160522, None, 120),  # "Betriebshof Lichtenberg"
+    ((13.4964867, 52.4654085), "Betriebshof Köpenicker Landstraße", 200),
+    ((13.5053889, 52.4714167), "Betriebshof Rummelsburger Landstraße", 60),
+    ((13.3844563, 52.416735), "Betriebshof Säntisstraße", 230),
+    ((13.5401389, 52.5123056), "Betriebshof Alt Friedrichsfelde", 135),
+]
+
+# All depots share the same vehicle type list
+depot_list: List[Dict[str, Union[int, str, Tuple[float, float], List[int]]]] = []
+for station, name, capacity in depot_entries:
+    depot = {
+        "depot_station": station,
+        "capacity": capacity,
         "vehicle_type": all_vehicle_type_ids,
     }
-)
+    if name is not None:
+        depot["name"] = name
+    depot_list.append(depot)
 
-# "Betriebshof Säntisstraße" will have a capacity of 230
-depot_list.append(
-    {
-        "depot_station": (13.3844563, 52.416735),
-        "name": "Betriebshof Säntisstraße",
-        "capacity": 230,
-        "vehicle_type": all_vehicle_type_ids,
-    }
-)
-
-# "Betriebshof Alt Friedrichsfelde" will have a capacity of 135
-depot_list.append(
-    {
-        "depot_station": (13.5401389, 52.5123056),
-        "name": "Betriebshof Alt Friedrichsfelde",
-        "capacity": 135,
-        "vehicle_type": all_vehicle_type_ids,
-    }
-)
 
+# The optimizer requires a "BASE_URL" environment variable to be set. This should be the URL of the API server for the openrouteservice instance that the optimizer will use.
+# It is set before the optimizer is created, so that all of its routing requests use the same server.
+os.environ["BASE_URL"] = "http://mpm-v-ors.mpm.tu-berlin.de:8080/ors/"
 
 # # Intialize the Optimizer
 optimizer = DepotRotationOptimizer(session, SCENARIO_ID)
 optimizer.get_depot_from_input(depot_list)
 
-# The optimizer requires a "BASE_URL" environment variable to be set. This should be the URL of the API server for the openrouteservice instance that the optimizer will use.
-os.environ["BASE_URL"] = "http://mpm-v-ors.mpm.tu-berlin.de:8080/ors/"
 optimizer.data_preparation()
 optimizer.optimize()
 optimizer.write_optimization_results(delete_original_data=True)
@@ -168,59 +169,63 @@ assert optimizer.data["result"].shape[0] == optimizer.data["rotation"].shape[0]
 
 fig = optimizer.visualize()
 fig.write_html(os.path.join("src", "media", "sankey.html"))
-fig.write_image(os.path.join("src", "media", "sankey.svg"))
+# The SVG export starts a headless browser (kaleido), which takes a while. We run it in the background while the
+# post-optimization plot is prepared. The image size is fixed up front, so kaleido does not need to determine it.
+pio.kaleido.scope.default_format = "svg"
+pio.kaleido.scope.default_width = 1200
+pio.kaleido.scope.default_height = 800
+background_executor = ThreadPoolExecutor(max_workers=1)
+sankey_svg_future = background_executor.submit(
+    fig.write_image, os.path.join("src", "media", "sankey.svg")
+)
 
 # Save a geographic trip plot
-# We will need to flush and expunge the session in order for the geom to be converted to binary
-# (which is necessary for the plot to be created)
-session.flush()
-session.expunge_all()
-post_df = prepare_geographic_trip_plot(1, session)
+# The geoms of the new objects need to be read back from the database as binary (which is necessary for the plot to be
+# created). So we commit the optimization results and load the plot data in a fresh session.
+session.commit()
+with Session(engine) as plot_session:
+    post_df = prepare_geographic_trip_plot(1, plot_session)
 post_map = visualize_geographic_trip_plot(post_df)
 post_map.save(os.path.join("src", "media", "post_opt_geographic_trip_plot.html"))
 
+# Wait for the SVG export, so that any errors in it are raised here
+sankey_svg_future.result()
+background_executor.shutdown()
+
 
 # Also, prepare for a bar chart of how many rotations each depot supports
-# Create a counter of the number of rotations per depot
-post_opt_counter = Counter()
-dropped = post_df.drop_duplicates(subset=["rotation_id"])
-grouped = dropped.groupby("originating_depot_name")
-for depot, group in grouped:
-    name_and_id = group[["originating_depot_name", "originating_depot_id"]].iloc[0]
-    print(list(name_and_id))
-    post_opt_counter[depot] = len(group)
-
-# Make sure the pre- and post-optimization counters have the same keys
-all_keys = set(pre_opt_counter.keys()).union(set(post_opt_counter.keys()))
-for key in all_keys:
-    if key not in pre_opt_counter:
-        pre_opt_counter[key] = 0
-    if key not in post_opt_counter:
-        post_opt_counter[key] = 0
+# Create a series of the number of rotations per depot
+post_opt_depot_counts = depot_counts(post_df)
+for row in post_opt_depot_counts.itertuples(index=False):
+    print([row.originating_depot_name, row.originating_depot_id])
+post_opt_counts = post_opt_depot_counts.groupby("originating_depot_name")["n"].sum()
 
-# Compare the number of rotations per depot before and after optimization in a barh plot
-fig, ax = plt.subplots()
-ind = np.arange(len(pre_opt_counter))
-width = 0.4
+# The trip dataframe and the map are not needed anymore, release them before plotting
+del post_df, post_map
 
-# Turn the counter dictionaries into lists
-keys = list(pre_opt_counter.keys())
-pre_opt_values = [pre_opt_counter[key] for key in keys]
-post_opt_values = [post_opt_counter[key] for key in keys]
+# Compare the number of rotations per depot before and after optimization in a barh plot
+# Align the two series into one dataframe
+# Depots missing from one of the series are counted as zero
+counts = (
+    pd.concat(
+        {"Before Optimization": pre_opt_counts, "After Optimization": post_opt_counts},
+        axis=1,
+    )
+    .fillna(0)
+    .astype(int)
+    .sort_index()
+)
 
-ax.barh(ind - width / 2, pre_opt_values, width, label="Before Optimization")
-ax.barh(ind + width / 2, post_opt_values, width, label="After Optimization")
+# Pandas places the bars of both columns next to each other and labels the y-ticks with the depot names
+fig, ax = plt.subplots()
+counts.plot.barh(ax=ax, width=0.8)
 ax.set_xlabel("Number of Rotations")
 ax.set_ylabel("Depot")
 ax.legend()
 
-# Set the y-ticks to the depot names (keys)
-ax.set_yticks(ind)
-ax.set_yticklabels(keys)
-
 plt.tight_layout()
 plt.savefig(os.path.join("src", "media", "depot_rotations_opt.svg"))
-plt.show()
+plt.close(fig)
 
 session.commit()
 session.close()
@@ -8,16 +8,24 @@ and splitting rotations.
 import argparse
 import json
 import logging
-import multiprocessing
 import os
 import uuid
 import warnings
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import timedelta
 import random
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Set
 from urllib.parse import urlparse
 
+# Every optimization path runs in its own worker process. Limit the numerical libraries to one thread each, so the
+# workers do not oversubscribe the cores. This needs to happen before numpy is imported.
+for thread_count_variable in (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+):
+    os.environ.setdefault(thread_count_variable, "1")
+
 import numpy as np
 import pandas as pd
 import sqlalchemy.orm.session
@@ -25,8 +33,10 @@ from ds_wrapper import DjangoSimbaWrapper
 from eflips.model import *
 from eflips.model import ConsistencyWarning
 from matplotlib import pyplot as plt
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, delete, func, select, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, joinedload
 
 # We can ignore the ConsistencyWarning, as we are not interested in the consistency of rotations in this script.
 warnings.simplefilter("ignore", category=ConsistencyWarning)
@@ -36,7 +46,9 @@ def list_scenarios(database_url: str, session: sqlalchemy.orm.session.Session) -
     scenarios = session.query(Scenario).all()
     for scenario in scenarios:
         rotation_count = (
-            session.query(Rotation).filter(Rotation.scenario_id == scenario.id).count()
+            session.query(func.count(Rotation.id))
+            .filter(Rotation.scenario_id == scenario.id)
+            .scalar()
         )
         print(f"{scenario.id}: {scenario.name} with {rotation_count} rotations.")
 
@@ -58,13 +70,18 @@ def database_url_components(database_url: str) -> Tuple[str, str, str, str, str,
 
 
 def create_temporary_databases(
-    orig_database_url: str, count: int, random_prefix: str
+    orig_database_url: str,
+    count: int,
+    random_prefix: str,
+    template_database_url: str | None = None,
 ) -> List[str]:
     """
     Creates a number of temporary databases by cloning the original database.
     :param orig_database_url: The URL of the original database. It will be used to find username, password, etc.
     :param count: How many databases to create.
     :param random_prefix: A random prefix to add to the database name.
+    :param template_database_url: The URL of the database to clone. If it is not given, the original database is
+    cloned.
     :return: A list of URLs of the new databases.
     """
     logger = logging.getLogger(__name__)
@@ -72,20 +89,39 @@ def create_temporary_databases(
     _, database_user, database_password, database_host, database_port, database_name = (
         database_url_components(orig_database_url)
     )
+    if template_database_url is not None:
+        template_database_name = make_url(template_database_url).database
+    else:
+        template_database_name = database_name
+
+    # All databases are created over a single connection to the maintenance database. CREATE DATABASE cannot run
+    # inside a transaction, so the connection is in autocommit mode.
+    maintenance_engine = create_engine(
+        make_url(orig_database_url).set(database="postgres"),
+        isolation_level="AUTOCOMMIT",
+    )
 
     new_database_urls = []
-    for i in range(count):
-        new_database_name = f"{database_name}_{random_prefix}_{i}"
-        new_database_url = f"postgresql://{database_user}:{database_password}@{database_host}:{database_port}/{new_database_name}"
-        new_database_urls.append(new_database_url)
-        os.environ["PGPASSWORD"] = database_password
-        result = os.system(
-            f"createdb -h {database_host} -U {database_user} -p {database_port} {new_database_name} -T {database_name}"
-        )
-        if result != 0:
-            logger.error(f"Could not create database {new_database_name}.")
-            raise ValueError(f"Could not create database {new_database_name}.")
-        logger.info(f"Created database {new_database_name}.")
+    try:
+        with maintenance_engine.connect() as connection:
+            for i in range(count):
+                new_database_name = f"{database_name}_{random_prefix}_{i}"
+                new_database_url = f"postgresql://{database_user}:{database_password}@{database_host}:{database_port}/{new_database_name}"
+                new_database_urls.append(new_database_url)
+                try:
+                    connection.execute(
+                        text(
+                            f'CREATE DATABASE "{new_database_name}" TEMPLATE "{template_database_name}"'
+                        )
+                    )
+                except DBAPIError as e:
+                    logger.error(f"Could not create database {new_database_name}.")
+                    raise ValueError(
+                        f"Could not create database {new_database_name}."
+                    ) from e
+                logger.info(f"Created database {new_database_name}.")
+    finally:
+        maintenance_engine.dispose()
     return new_database_urls
 
 
@@ -102,41 +138,103 @@ def delete_temporary_databases(
 
     logger = logging.getLogger(__name__)
 
-    _, database_user, database_password, database_host, database_port, database_name = (
-        database_url_components(orig_database_url)
+    database_name = make_url(orig_database_url).database
+
+    # Like in create_temporary_databases(), the databases are dropped over connections to the maintenance database in
+    # autocommit mode, as DROP DATABASE cannot run inside a transaction either. The databases are independent of each
+    # other, so they are dropped concurrently, each over a connection of its own.
+    maintenance_engine = create_engine(
+        make_url(orig_database_url).set(database="postgres"),
+        isolation_level="AUTOCOMMIT",
+        pool_size=count,
+        max_overflow=0,
     )
 
-    for i in range(count):
-        new_database_name = f"{database_name}_{random_prefix}_{i}"
-        os.environ["PGPASSWORD"] = database_password
-        result = os.system(
-            f"dropdb -h {database_host} -U {database_user} -p {database_port} {new_database_name}"
-        )
-        if result != 0:
-            logger.error(f"Could not delete database {new_database_name}.")
-            raise ValueError(f"Could not delete database {new_database_name}.")
+    def drop_database(new_database_name: str) -> None:
+        with maintenance_engine.connect() as connection:
+            try:
+                connection.execute(text(f'DROP DATABASE "{new_database_name}"'))
+            except DBAPIError as e:
+                logger.error(f"Could not delete database {new_database_name}.")
+                raise ValueError(
+                    f"Could not delete database {new_database_name}."
+                ) from e
         logger.info(f"Deleted database {new_database_name}.")
 
+    try:
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            # Consuming the results re-raises the first error in this thread
+            list(
+                executor.map(
+                    drop_database,
+                    (f"{database_name}_{random_prefix}_{i}" for i in range(count)),
+                )
+            )
+    finally:
+        maintenance_engine.dispose()
+
 
-def number_of_rotations_below_zero(scenario: Scenario, session: Session) -> int:
+def simulate_initial_state(scenario_id: int, database_url: str) -> None:
+    """
+    Simulates the scenario once and creates the low SOC event index, so that the databases cloned from this database
+    already contain the simulation results for the unmodified scenario and the index.
+    :param scenario_id: The id of the scenario to simulate.
+    :param database_url: The URL of the database to operate on.
+    :return: Nothing.
     """
-    Counts the number of rotations in a scenario where the SOC at the depot is below 0%.
+    ds_wrapper = DjangoSimbaWrapper(database_url)
+    ds_wrapper.run_simba_scenario(scenario_id, assign_vehicles=True)
+
+    # The engine is disposed right away, as the database can only be cloned once no connections are open.
+    engine = create_engine(database_url)
+    try:
+        create_low_soc_event_index(engine)
+    finally:
+        engine.dispose()
+
+
+def negative_rotations(scenario: Scenario, session: Session) -> List[Tuple[int, float]]:
+    """
+    Finds all rotations in a scenario where the SOC drops below 0%, together with their lowest SOC.
     :param scenario: The scenario to check.
     :param session: The database session.
-    :return: The number of rotations with SOC below 0%.
+    :return: A list of (rotation id, lowest SOC) tuples, one for each rotation with SOC below 0%.
     """
     rotations_q = (
-        session.query(Rotation)
+        session.query(Rotation.id, func.min(Event.soc_end))
         .join(Trip)
         .join(Event)
         .filter(Rotation.scenario_id == scenario.id)
         .filter(Event.event_type == EventType.DRIVING)
         .filter(Event.soc_end < 0)
+        .group_by(Rotation.id)
     )
-    return rotations_q.count()
+    return [(rotation_id, lowest_soc) for rotation_id, lowest_soc in rotations_q]
 
 
-def add_charging_station(scenario, session, power: float = 300) -> int | None:
+def create_low_soc_event_index(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates a partial index on the driving events with SOC below 0%, if it does not exist yet. These events are looked
+    up in every step of the optimization, and the index lets the database find them without scanning all events.
+    :param engine: An engine connected to the database to create the index in.
+    :return: Nothing.
+    """
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS ix_event_low_soc ON "{Event.__tablename__}" '
+                f"(scenario_id, event_type, soc_end) WHERE soc_end < 0"
+            )
+        )
+
+
+def add_charging_station(
+    scenario,
+    session,
+    power: float = 300,
+    excluded_station_ids: Set[int] | None = None,
+    rotations_below_zero: List[Tuple[int, float]] | None = None,
+) -> int | None:
     """
     Adds a charging station to the scenario. The heuristic for selecting the charging station is to add is to select
     the one where the rotations with negative SoC spend the most time. If no such charging station can be found, None
@@ -145,60 +243,78 @@ def add_charging_station(scenario, session, power: float = 300) -> int | None:
     :param scenario: THE scenario to add the charging station to.
     :param session: An open database session.
     :param power: The power of the charging station to be added. Default is 300 kW.
+    :param excluded_station_ids: The ids of stations that should not be selected, e.g. because they were already
+    electrified since the last simulation.
+    :param rotations_below_zero: The result of `negative_rotations()` for the current state of the scenario. If it is
+    given, the rotations with negative SoC are taken from it instead of being looked up in the events.
     :return: Either the id of the charging station that was added, or None if no charging station could be added.
     """
     # First, we identify all the rotations containing a SoC < 0 event
     logger = logging.getLogger(__name__)
 
-    rotations_with_low_soc = (
-        session.query(Rotation)
-        .join(Trip)
-        .join(Event)
-        .filter(Event.soc_end < 0)
-        .filter(Event.event_type == EventType.DRIVING)
-        .filter(Event.scenario == scenario)
-        .options(sqlalchemy.orm.joinedload(Rotation.trips).joinedload(Trip.route))
-        .all()
-    )
-
-    # For these rotations, we find all the arrival statiosn but the last one. The last one is the depot.
-    # We sum up the time spent at a break at each of these stations.
-    total_break_time_by_station = Counter()
-    for rotation in rotations_with_low_soc:
-        for i in range(len(rotation.trips) - 1):
-            trip = rotation.trips[i]
-            total_break_time_by_station[trip.route.arrival_station_id] += int(
-                (
-                    rotation.trips[i + 1].departure_time - trip.arrival_time
-                ).total_seconds()
-            )
+    if rotations_below_zero is not None:
+        rotations_with_low_soc = [
+            rotation_id for rotation_id, _ in rotations_below_zero
+        ]
+    else:
+        rotations_with_low_soc = (
+            select(Trip.rotation_id)
+            .join(Event, Event.trip_id == Trip.id)
+            .filter(Event.soc_end < 0)
+            .filter(Event.event_type == EventType.DRIVING)
+            .filter(Event.scenario == scenario)
+        )
 
-    # If all stations have a score iof 0, we terminate the optimization
-    if all(v == 0 for v in total_break_time_by_station.values()):
+    # For these rotations, we find all the arrival stations but the last one. The last one is the depot.
+    # We sum up the time spent at a break at each of these stations. This is done in the database: The break after a
+    # trip lasts until the departure of the next trip in the same rotation, which is NULL for the last trip.
+    next_departure_time = func.lead(Trip.departure_time).over(
+        partition_by=Trip.rotation_id, order_by=Trip.departure_time
+    )
+    breaks = (
+        select(
+            Route.arrival_station_id.label("station_id"),
+            (next_departure_time - Trip.arrival_time).label("break_time"),
+        )
+        .join(Route, Trip.route_id == Route.id)
+        .filter(Trip.rotation_id.in_(rotations_with_low_soc))
+        .subquery()
+    )
+    total_break_time = func.sum(func.extract("epoch", breaks.c.break_time))
+    station_q = select(breaks.c.station_id, total_break_time)
+    if excluded_station_ids:
+        station_q = station_q.filter(breaks.c.station_id.not_in(excluded_station_ids))
+    # Ties are broken by the station id, so the same station is selected in every run
+    most_popular_station = session.execute(
+        station_q.group_by(breaks.c.station_id)
+        .order_by(total_break_time.desc().nulls_last(), breaks.c.station_id)
+        .limit(1)
+    ).one_or_none()
+
+    # If all stations have a score of 0, we terminate the optimization
+    if most_popular_station is None or not most_popular_station[1]:
         return None
 
-    most_popular_station_id = total_break_time_by_station.most_common(1)[0][0]
-    if logger.isEnabledFor(logging.DEBUG):
-        station_name = (
-            session.query(Station)
-            .filter(Station.id == most_popular_station_id)
-            .one()
-            .name
-        )
-        logger.debug(
-            f"Station {most_popular_station_id} ({station_name}) was selected as the station where the most time is spent."
+    most_popular_station_id = most_popular_station[0]
+
+    # Actually add the charging station in the database. The name is only returned for the debug log.
+    amount_charging_places = 100
+    _, station_name = session.execute(
+        update(Station)
+        .where(Station.id == most_popular_station_id)
+        .values(
+            is_electrified=True,
+            amount_charging_places=amount_charging_places,
+            power_per_charger=power,
+            power_total=amount_charging_places * power,
+            charge_type=ChargeType.OPPORTUNITY,
+            voltage_level=VoltageLevel.MV,
         )
-
-    # Actually add the charging station in the database.
-    station: Station = (
-        session.query(Station).filter(Station.id == most_popular_station_id).one()
+        .returning(Station.id, Station.name)
+    ).one()
+    logger.debug(
+        f"Station {most_popular_station_id} ({station_name}) was selected as the station where the most time is spent."
     )
-    station.is_electrified = True
-    station.amount_charging_places = 100
-    station.power_per_charger = power
-    station.power_total = station.amount_charging_places * station.power_per_charger
-    station.charge_type = ChargeType.OPPORTUNITY
-    station.voltage_level = VoltageLevel.MV
 
     return most_popular_station_id
 
@@ -207,65 +323,81 @@ def split_rotation(
     scenario,
     session: Session,
     deadhead_break: timedelta = timedelta(minutes=5),
+    rotations_below_zero: List[Tuple[int, float]] | None = None,
 ) -> int | None:
     """
     Splits a rotation in the scenario. The rotation with the lowest SoC at the depot is selected for splitting. The
     rotation is split in its middle.
     :param scenario: The scenario to split the rotation in.
-    :param max_rotation_id: The maximum id of the rotation to split. This is used to avoid splitting the same rotation
-    multiple times.
     :param session: An open database session.
     :param deadhead_break: The break between the deadhead trips that are added and the passenger trips. Default is 5
     minutes.
-    :return: The id of the rotation that was split, or None if no rotation could be split.
+    :param rotations_below_zero: The result of `negative_rotations()` for the current state of the scenario. If it is
+    given, the rotation to split is taken from it instead of querying the database again.
+    :return: The id of the rotation that was split, or None if there is no rotation with negative SoC or the selected
+    rotation cannot be split.
     """
 
-    lowest_soc_event_q: Event = (
-        session.query(Event)
-        .join(Trip)
-        .join(Rotation)
-        .filter(Event.soc_end < 0)
-        .filter(Event.event_type == EventType.DRIVING)
-        .filter(Event.scenario == scenario)
-        .order_by(Event.soc_end)
-    )
-    if lowest_soc_event_q.count() == 0:
-        return None
+    if rotations_below_zero is not None:
+        if len(rotations_below_zero) == 0:
+            return None
+        rotation_id = min(rotations_below_zero, key=lambda r: r[1])[0]
     else:
-        lowest_soc_event = lowest_soc_event_q.first()
-    rotation_id = lowest_soc_event.trip.rotation_id
+        rotation_id = session.execute(
+            select(Trip.rotation_id)
+            .join(Event, Event.trip_id == Trip.id)
+            .filter(Event.soc_end < 0)
+            .filter(Event.event_type == EventType.DRIVING)
+            .filter(Event.scenario == scenario)
+            .order_by(Event.soc_end)
+            .limit(1)
+        ).scalar_one_or_none()
+        if rotation_id is None:
+            return None
 
     # Actually split the rotation.
-    rotation = session.query(Rotation).filter(Rotation.id == rotation_id).one()
+    # The trips and their routes are needed for the distances and the deadhead trips, so they are loaded together
+    rotation = (
+        session.query(Rotation)
+        .filter(Rotation.id == rotation_id)
+        .options(joinedload(Rotation.trips).joinedload(Trip.route))
+        .one()
+    )
     assert isinstance(rotation, Rotation)  # To make mypy happy
 
     # Find the total distance and the trips that are near the middle
+    # The middle trip is the one during which half of the total distance is passed
     trip_distances = [trip.route.distance for trip in rotation.trips]
-    total_distance = sum(trip_distances)
-    cumulative_distances = np.cumsum(trip_distances)
-    middle_trip_index = np.argmax(cumulative_distances > total_distance / 2)
+    half_distance = sum(trip_distances) / 2
+    cumulative_distance = 0
+    middle_trip_index = 0
+    for i, trip_distance in enumerate(trip_distances):
+        cumulative_distance += trip_distance
+        if cumulative_distance > half_distance:
+            middle_trip_index = i
+            break
+
+    # If the first trip already covers half the distance, or there are too few trips, there is nothing to split. The
+    # first half would be empty, or splitting would just create rotations of the same shape again.
+    if middle_trip_index == 0 or len(trip_distances) < 3:
+        return None
 
     # Create the new rotations
     # The deadhead trips are time-shifted copies of the first/last trip of the original rotation
-    first_trips = rotation.trips[:middle_trip_index]
-
-    # Delete the original rotation
     saved_trips_sequence = rotation.trips.copy()
-    rotation.trips = []
-    session.delete(rotation)
+    first_trips = saved_trips_sequence[:middle_trip_index]
+    second_trips = saved_trips_sequence[middle_trip_index:]
+    first_trip, last_trip = saved_trips_sequence[0], saved_trips_sequence[-1]
 
     deadhead_after_start = first_trips[-1].arrival_time + deadhead_break
-    deadhead_after_duration = (
-        saved_trips_sequence[-1].arrival_time - saved_trips_sequence[-1].departure_time
-    )
+    deadhead_after_duration = last_trip.arrival_time - last_trip.departure_time
     deadhead_after = Trip(
         scenario_id=rotation.scenario_id,
-        route=saved_trips_sequence[-1].route,
+        route=last_trip.route,
         departure_time=deadhead_after_start,
         arrival_time=deadhead_after_start + deadhead_after_duration,
         trip_type=TripType.EMPTY,
     )
-    first_trips.append(deadhead_after)
 
     rotation_a = Rotation(
         scenario_id=rotation.scenario_id,
@@ -273,24 +405,19 @@ def split_rotation(
         vehicle_type_id=rotation.vehicle_type_id,
         allow_opportunity_charging=rotation.allow_opportunity_charging,
     )
-    rotation_a.trips = first_trips
+    rotation_a.trips = [deadhead_after]
     session.add(deadhead_after)
     session.add(rotation_a)
 
-    second_trips = saved_trips_sequence[middle_trip_index:]
-
     deadhead_before_end = second_trips[0].departure_time - deadhead_break
-    deadhead_before_duration = (
-        saved_trips_sequence[0].arrival_time - saved_trips_sequence[0].departure_time
-    )
+    deadhead_before_duration = first_trip.arrival_time - first_trip.departure_time
     deadhead_before = Trip(
         scenario_id=rotation.scenario_id,
-        route=saved_trips_sequence[0].route,
+        route=first_trip.route,
         departure_time=deadhead_before_end - deadhead_before_duration,
         arrival_time=deadhead_before_end,
         trip_type=TripType.EMPTY,
     )
-    second_trips.insert(0, deadhead_before)
 
     rotation_b = Rotation(
         scenario_id=rotation.scenario_id,
@@ -298,15 +425,41 @@ def split_rotation(
         vehicle_type_id=rotation.vehicle_type_id,
         allow_opportunity_charging=rotation.allow_opportunity_charging,
     )
-    rotation_b.trips = second_trips
+    rotation_b.trips = [deadhead_before]
     session.add(deadhead_before)
     session.add(rotation_b)
 
+    # The new rotations need their ids before the existing trips can be moved to them
+    session.flush()
+
+    # Move the existing trips to the new rotations and delete the original rotation. This is done with one statement
+    # each, instead of the ORM updating every trip and cascading the delete.
+    session.execute(
+        update(Trip)
+        .where(Trip.id.in_([trip.id for trip in first_trips]))
+        .values(rotation_id=rotation_a.id)
+    )
+    session.execute(
+        update(Trip)
+        .where(Trip.id.in_([trip.id for trip in second_trips]))
+        .values(rotation_id=rotation_b.id)
+    )
+    session.execute(delete(Rotation).where(Rotation.id == rotation_id))
+
+    # The trip lists of the new rotations only contain the deadhead trips so far, reload them when they are accessed
+    session.expire(rotation_a, ["trips"])
+    session.expire(rotation_b, ["trips"])
+
     return rotation_id
 
 
 def optimize_rotation(
-    scenario_id: int, database_url: str, random_bias: float, power: float = 300
+    scenario_id: int,
+    database_url: str,
+    random_bias: float,
+    power: float = 300,
+    batch_size: int = 1,
+    initial_simulation: bool = True,
 ) -> List[Dict[str, int]]:
     """
     Optimizes a rotation by adding charging stations and splitting rotations. The optimiztaion is done by iteratively
@@ -316,25 +469,51 @@ def optimize_rotation(
     :param scenario_id: The id of the scenario to optimize.
     :param database_url: The URL of the database to operate on.
     :param random_bias: A bias between 0 and 1. With 0 only rotation splitting is done, with 1 only charging stations
-    are added.
+    are added. If the chosen heuristic finds nothing to do, the other one is used instead.
     :param power: The power of the charging stations to be added. in kW. Default is 300 kW.
+    :param batch_size: How many actions are taken before the scenario is simulated again. Within one batch, no rotation
+    is split twice and no station is electrified twice. If a batch does not reduce the number of rotations below 0%
+    SOC, the optimization continues with one action per simulation. Larger batches need fewer simulations, but the
+    actions in a batch are all chosen from the same simulation results and only one step is recorded per batch.
+    Default is 1, which simulates after every action.
+    :param initial_simulation: Whether to simulate the scenario and create the low SOC event index before the first
+    step. Can be set to False if the database was prepared by `simulate_initial_state()`.
     :return: A tuple with two lists. The first list contains the ids of the charging stations that were added, the
     second list contains the ids of the rotations that were split.
     """
     logger = logging.getLogger(__name__)
 
     assert 0 <= random_bias <= 1
+    assert batch_size >= 1
 
-    # Run the simulation once to get the initial state.
-    ds_wrapper = DjangoSimbaWrapper(database_url)
-    ds_wrapper.run_simba_scenario(scenario_id, assign_vehicles=True)
-    del ds_wrapper
+    # The worker processes are forked from the same parent and would inherit the same RNG state. So we seed the RNG
+    # once for each optimization.
+    random.seed(os.urandom(32))
 
-    engine = create_engine(database_url)
+    # Run the simulation once to get the initial state, unless the database already contains it.
+    # The wrapper is reused for all simulations in this optimization, so the connection is only set up once.
+    ds_wrapper = DjangoSimbaWrapper(database_url)
+    if initial_simulation:
+        ds_wrapper.run_simba_scenario(scenario_id, assign_vehicles=True)
+
+    # This engine is only used by one session. The temporary database is discarded after the optimization, so its
+    # many intermediate commits do not need to wait for the WAL to be flushed to disk.
+    engine = create_engine(
+        database_url,
+        pool_size=1,
+        pool_pre_ping=False,
+        connect_args={
+            "application_name": f"rotation-optimization-{os.getpid()}",
+            "options": "-c synchronous_commit=off",
+        },
+    )
+    if initial_simulation:
+        create_low_soc_event_index(engine)
     session = Session(engine)
     try:
         scenario = session.query(Scenario).filter(Scenario.id == scenario_id).one()
-        current_value = number_of_rotations_below_zero(scenario, session)
+        rotations_below_zero = negative_rotations(scenario, session)
+        current_value = len(rotations_below_zero)
 
         added_charging_stations: List[int] = (
             []
@@ -346,46 +525,99 @@ def optimize_rotation(
         )  # The results of each step in the optimization.
 
         while current_value > 0:
-            # We need to seed our RNG each time???
-            random.seed(os.urandom(32))
-            # Choose a random action to take.
-            random_value = random.random()
-            # Write the random value and the bias to a debug log.
-            logger.debug(
-                f"Random value: {random_value}, random bias: {random_bias} (PID: {os.getpid()})"
-            )
-            if random_value < random_bias:
-                # Add a charging station.
-                logger.debug(f"Adding a charging station to scenario {scenario_id}.")
-                station_that_had_charger_added = add_charging_station(scenario, session)
-                if station_that_had_charger_added is not None:
-                    added_charging_stations.append(station_that_had_charger_added)
-                else:
-                    logger.warning(
-                        f"No charging station could be added to scenario {scenario_id}."
+            # Take up to batch_size actions before running the simulation again. The actions in one batch are all
+            # based on the last simulation (rotations_below_zero), so we keep track of the rotations and stations that
+            # were already changed.
+            split_in_batch: Set[int] = set()
+            electrified_in_batch: Set[int] = set()
+            actions_in_batch = 0
+            # If one of the heuristics finds nothing to do, the other one is tried. We only stop if both fail.
+            charging_exhausted = False
+            splitting_exhausted = False
+            while actions_in_batch < batch_size:
+                # Choose a random action to take.
+                random_value = random.random()
+                # Write the random value and the bias to a debug log.
+                logger.debug(
+                    f"Random value: {random_value}, random bias: {random_bias} (PID: {os.getpid()})"
+                )
+                add_charger = random_value < random_bias
+                if charging_exhausted:
+                    add_charger = False
+                elif splitting_exhausted:
+                    add_charger = True
+
+                if add_charger:
+                    # Add a charging station.
+                    logger.debug(
+                        f"Adding a charging station to scenario {scenario_id}."
+                    )
+                    station_that_had_charger_added = add_charging_station(
+                        scenario,
+                        session,
+                        excluded_station_ids=electrified_in_batch,
+                        rotations_below_zero=rotations_below_zero,
                     )
-                    break
-            else:
-                # Split a rotation.
-                logger.debug(f"Splitting a rotation in scenario {scenario_id}.")
-                rotation_that_was_split = split_rotation(scenario, session)
-                if rotation_that_was_split is not None:
-                    split_rotations.append(rotation_that_was_split)
+                    if station_that_had_charger_added is not None:
+                        added_charging_stations.append(station_that_had_charger_added)
+                        electrified_in_batch.add(station_that_had_charger_added)
+                    elif actions_in_batch > 0:
+                        # Nothing left to do based on the last simulation, simulate the batch so far
+                        break
+                    else:
+                        logger.warning(
+                            f"No charging station could be added to scenario {scenario_id}."
+                        )
+                        charging_exhausted = True
+                        if splitting_exhausted:
+                            break
+                        continue
                 else:
-                    logger.warning(
-                        f"No rotation could be split in scenario {scenario_id}."
+                    # Split a rotation.
+                    logger.debug(f"Splitting a rotation in scenario {scenario_id}.")
+                    unsplit_rotations_below_zero = [
+                        r for r in rotations_below_zero if r[0] not in split_in_batch
+                    ]
+                    rotation_that_was_split = split_rotation(
+                        scenario,
+                        session,
+                        rotations_below_zero=unsplit_rotations_below_zero,
                     )
-                    break
+                    if rotation_that_was_split is not None:
+                        split_rotations.append(rotation_that_was_split)
+                        split_in_batch.add(rotation_that_was_split)
+                    elif actions_in_batch > 0:
+                        # Nothing left to do based on the last simulation, simulate the batch so far
+                        break
+                    else:
+                        logger.warning(
+                            f"No rotation could be split in scenario {scenario_id}."
+                        )
+                        splitting_exhausted = True
+                        if charging_exhausted:
+                            break
+                        continue
+                actions_in_batch += 1
+
+            if charging_exhausted and splitting_exhausted:
+                break
 
             # Run the consumption simulation to see if the scenario is feasible.
+            # The simulation runs in its own (Django) session, so we commit our changes before. There is no need to
+            # expire our session afterwards, as the commit already expires all loaded objects, and the results are read
+            # by queries that bypass the identity map.
             session.commit()
-            ds_wrapper = DjangoSimbaWrapper(database_url)
-            ds_wrapper.run_simba_scenario(scenario.id, assign_vehicles=True)
-            del ds_wrapper
-            session.commit()
-            session.expire_all()
-
-            current_value = number_of_rotations_below_zero(scenario, session)
+            ds_wrapper.run_simba_scenario(scenario_id, assign_vehicles=True)
+
+            previous_value = current_value
+            rotations_below_zero = negative_rotations(scenario, session)
+            current_value = len(rotations_below_zero)
+            if batch_size > 1 and current_value >= previous_value:
+                # Acting on a stale simulation did not pay off, continue with single actions
+                logger.info(
+                    f"Batch of {actions_in_batch} actions did not improve scenario {scenario_id}, using single actions."
+                )
+                batch_size = 1
             step_results.append(
                 {
                     "electrified_station_count": len(added_charging_stations),
@@ -519,6 +751,13 @@ if __name__ == "__main__":
         help="The number of paths to explore.",
         default=5,
     )
+    parser.add_argument(
+        "--batch_size",
+        "--batch-size",
+        type=int,
+        help="The number of actions to take before simulating the scenario again. Values above 1 need fewer simulations, but record fewer steps.",
+        default=1,
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -526,6 +765,9 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
+    if args.batch_size < 1:
+        parser.error("The batch size must be at least 1.")
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
@@ -559,17 +801,55 @@ if __name__ == "__main__":
         # Performance hack: We do not clone the scenario, but instead clone the whole database for each path we explore.
         # This seems to be quite a bit faster.
         random_prefix = uuid.uuid4().hex
-        new_database_urls = create_temporary_databases(
-            args.database_url, args.paths, random_prefix
-        )
+
+        # The initial simulation is the same for every path. If there are more paths than cores, the paths cannot all
+        # run their initial simulation in parallel anyway. Then it is only run once, in a database of its own, and the
+        # databases for the paths are cloned from that one. This saves CPU time, but adds a serial step, so it is not
+        # worth it when every path gets a core of its own. The simulation runs in a separate process, which closes its
+        # connections when it exits. PostgreSQL does not clone a database that still has open connections.
+        share_initial_simulation = args.paths > (os.cpu_count() or 1)
+        if share_initial_simulation:
+            initial_prefix = f"{random_prefix}_initial"
+            initial_database_url = create_temporary_databases(
+                args.database_url, 1, initial_prefix
+            )[0]
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                executor.submit(
+                    simulate_initial_state, args.scenario_id, initial_database_url
+                ).result()
+            new_database_urls = create_temporary_databases(
+                args.database_url,
+                args.paths,
+                random_prefix,
+                template_database_url=initial_database_url,
+            )
+            delete_temporary_databases(args.database_url, 1, initial_prefix)
+        else:
+            new_database_urls = create_temporary_databases(
+                args.database_url, args.paths, random_prefix
+            )
 
         pool_args = []
         for i in range(random_bias_range.size):
             random_bias = random_bias_range[i]
             database_url = new_database_urls[i]
             pool_args.append((args.scenario_id, database_url, random_bias))
-        with multiprocessing.Pool(random_bias_range.size) as pool:
-            all_results = pool.starmap(optimize_rotation, pool_args)
+        # Collect the results as the paths finish, but keep them in the order of the random biases.
+        all_results = [None] * len(pool_args)
+        with ProcessPoolExecutor(max_workers=random_bias_range.size) as executor:
+            futures = {
+                executor.submit(
+                    optimize_rotation,
+                    *pool_arg,
+                    batch_size=args.batch_size,
+                    initial_simulation=not share_initial_simulation,
+                ): i
+                for i, pool_arg in enumerate(pool_args)
+            }
+            for future in as_completed(futures):
+                path_index = futures[future]
+                all_results[path_index] = future.result()
+                logging.getLogger(__name__).info(f"Path {path_index} finished.")
 
         # Finally, clean up the temporary databases.
         delete_temporary_databases(args.database_url, args.paths, random_prefix)